@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from odoo import models, fields, api
-from odoo.exceptions import ValidationError
+from odoo.exceptions import AccessError, ValidationError
 from datetime import datetime, timedelta
+import base64
+import json
 import logging
+import psycopg2
+import zipfile
+from io import BytesIO
 
 logging.basicConfig(filename='/var/log/odoo/odoo-server.log.4', level=logging.DEBUG)
 
@@ -102,6 +107,9 @@ class BuildingType(models.Model):
     base_construction_time = fields.Integer(string="Base Construction Time", default=0)  # en minutos
     max_level = fields.Integer(string="Max Level", default=1)
 
+    _sql_constraints = [
+        ('name_uniq', 'unique(name)', 'This building type already exists')]
+
     @property
     def gold_cost(self):
         return self.base_gold_cost
@@ -577,6 +585,412 @@ class BattleWizard(models.TransientModel):
         }
 
 
+SNAPSHOT_FORMAT = 'game.snapshot'
+SNAPSHOT_VERSION = 1
+
+# (miembro del zip, tabla de staging, columnas, consulta de exportacion)
+# Las columnas de la consulta tienen que ir en el mismo orden que las de staging
+SNAPSHOT_TABLES = [
+    ('building_types.csv', 'game_snapshot_building_type', [
+        ('name', 'varchar'),
+        ('gold_production', 'integer'),
+        ('mana_production', 'integer'),
+        ('food_production', 'integer'),
+        ('troop_production', 'integer'),
+        ('base_gold_cost', 'integer'),
+        ('base_mana_cost', 'integer'),
+        ('base_food_cost', 'integer'),
+        ('base_construction_time', 'integer'),
+        ('max_level', 'integer'),
+        ('upgrade_gold_cost', 'integer'),
+        ('upgrade_mana_cost', 'integer'),
+        ('upgrade_food_cost', 'integer'),
+    ], """
+        SELECT name, gold_production, mana_production, food_production, troop_production,
+               base_gold_cost, base_mana_cost, base_food_cost, base_construction_time, max_level,
+               upgrade_gold_cost, upgrade_mana_cost, upgrade_food_cost
+          FROM game_building_type
+         ORDER BY id
+    """),
+    ('players.csv', 'game_snapshot_player', [
+        ('name', 'varchar'),
+        ('is_player', 'boolean'),
+        ('town_hall_level', 'varchar'),
+        ('gold', 'integer'),
+        ('mana', 'integer'),
+        ('food', 'integer'),
+        ('troops', 'integer'),
+    ], """
+        SELECT p.name, p.is_player, p.town_hall_level, p.gold, p.mana, p.food, p.troops
+          FROM res_partner p
+         WHERE p.is_player
+            OR p.id IN (SELECT player_id FROM game_building)
+            OR p.id IN (SELECT attacker_id FROM game_battle UNION SELECT defender_id FROM game_battle)
+         ORDER BY p.id
+    """),
+    ('buildings.csv', 'game_snapshot_building', [
+        ('player', 'varchar'),
+        ('building_type', 'varchar'),
+        ('level', 'integer'),
+        ('is_constructed', 'boolean'),
+        ('remaining_construction_time', 'integer'),
+        ('construction_time', 'integer'),
+        ('construction_start_time', 'timestamp'),
+        ('start_date', 'timestamp'),
+        ('end_date', 'date'),
+    ], """
+        SELECT p.name, t.name, b.level, b.is_constructed, b.remaining_construction_time,
+               b.construction_time, b.construction_start_time, b.start_date, b.end_date
+          FROM game_building b
+          JOIN res_partner p ON p.id = b.player_id
+          JOIN game_building_type t ON t.id = b.type_id
+         ORDER BY b.id
+    """),
+    ('battles.csv', 'game_snapshot_battle', [
+        ('attacker', 'varchar'),
+        ('defender', 'varchar'),
+        ('result', 'varchar'),
+        ('state', 'varchar'),
+        ('progress', 'integer'),
+        ('start_date', 'timestamp'),
+        ('end_date', 'timestamp'),
+    ], """
+        SELECT a.name, d.name, g.result, g.state, g.progress, g.start_date, g.end_date
+          FROM game_battle g
+          JOIN res_partner a ON a.id = g.attacker_id
+          JOIN res_partner d ON d.id = g.defender_id
+         ORDER BY g.id
+    """),
+]
+
+
+class SnapshotWizard(models.TransientModel):
+    _name = 'game.snapshot.wizard'
+    _description = 'World Snapshot Wizard'
+
+    snapshot_file = fields.Binary(string="Snapshot File", attachment=False)
+    snapshot_filename = fields.Char(string="File Name")
+
+    def action_export(self):
+        self.write({
+            'snapshot_file': base64.b64encode(self.export_snapshot()),
+            'snapshot_filename': 'game_snapshot_%s.zip' % fields.Datetime.now().strftime('%Y%m%d%H%M%S'),
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'World Snapshot',
+            'res_model': self._name,
+            'view_mode': 'form',
+            'target': 'new',
+            'res_id': self.id,
+        }
+
+    def action_import(self):
+        if not self.snapshot_file:
+            raise ValidationError("Select a snapshot file to import.")
+        self.import_snapshot(base64.b64decode(self.snapshot_file))
+        return {
+            'type': 'ir.actions.act_window',
+            'name': 'Players',
+            'res_model': 'res.partner',
+            'view_mode': 'tree,form',
+            'domain': [('is_player', '=', True)],
+            'target': 'current',
+        }
+
+    @api.model
+    def export_snapshot(self):
+        """Vuelca jugadores, tipos de edificio, edificios y batallas en un zip
+        con un CSV por tabla (via COPY) y un manifest.json con la version.
+
+        Los datos pasan por las mismas tablas temporales y la misma validacion
+        que la importacion, asi que todo lo que se exporta se puede importar."""
+        self._snapshot_check_access()
+        self.env.flush_all()
+        cr = self.env.cr
+        for member, table, columns, query in SNAPSHOT_TABLES:
+            self._snapshot_create_staging_table(table, columns)
+            cr.execute("INSERT INTO %s (%s) %s" % (
+                table, ', '.join(column for column, column_type in columns), query))
+            cr.execute("ANALYZE %s" % table)
+        self._snapshot_validate("The snapshot cannot be exported")
+
+        manifest = {'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION, 'tables': {}}
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for member, table, columns, query in SNAPSHOT_TABLES:
+                column_names = [column for column, column_type in columns]
+                with archive.open(member, 'w') as stream:
+                    cr.copy_expert("COPY %s (%s) TO STDOUT WITH CSV HEADER" % (
+                        table, ', '.join(column_names)), stream)
+                manifest['tables'][member] = {'columns': column_names, 'rows': cr.rowcount}
+            archive.writestr('manifest.json', json.dumps(manifest, indent=2))
+        return buffer.getvalue()
+
+    @api.model
+    def import_snapshot(self, data):
+        """Carga un snapshot con COPY en tablas temporales, lo valida de una vez
+        y lo fusiona con sentencias SQL por conjuntos.
+
+        Los tipos de edificio y los jugadores se emparejan por nombre. Los
+        edificios y batallas de los jugadores del snapshot se sustituyen."""
+        self._snapshot_check_access()
+        archive, manifest = self._snapshot_read_archive(data)
+        self.env.flush_all()
+        cr = self.env.cr
+        for member, table, columns, query in SNAPSHOT_TABLES:
+            self._snapshot_create_staging_table(table, columns)
+            try:
+                with cr.savepoint(flush=False), archive.open(member) as stream:
+                    cr.copy_expert("COPY %s (%s) FROM STDIN WITH CSV HEADER" % (
+                        table, ', '.join(column for column, column_type in columns)), stream)
+                    rows = cr.rowcount
+            except psycopg2.DataError as e:
+                raise ValidationError("The snapshot table %s is malformed: %s" % (member, e.diag.message_primary))
+            if rows != manifest['tables'][member]['rows']:
+                raise ValidationError("The snapshot table %s is truncated." % member)
+            # autovacuum no analiza tablas temporales, sin esto los joins se planifican a ciegas
+            cr.execute("ANALYZE %s" % table)
+
+        self._snapshot_validate("The snapshot cannot be imported")
+        self._snapshot_merge_building_types()
+        self._snapshot_merge_players()
+        self._snapshot_merge_buildings()
+        self._snapshot_merge_battles()
+        logging.info('Snapshot importado: %s', {member: manifest['tables'][member]['rows']
+                                                for member, table, columns, query in SNAPSHOT_TABLES})
+
+    def _snapshot_check_access(self):
+        # Las importaciones escriben con SQL directo y sudo(), saltandose las reglas de acceso
+        if not self.env.is_system():
+            raise AccessError("Only administrators can export or import world snapshots.")
+
+    def _snapshot_read_archive(self, data):
+        try:
+            archive = zipfile.ZipFile(BytesIO(data))
+            manifest = json.loads(archive.read('manifest.json'))
+        except (zipfile.BadZipFile, KeyError, ValueError):
+            raise ValidationError("The file is not a valid game snapshot.")
+        if not isinstance(manifest, dict) or manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValidationError("The file is not a valid game snapshot.")
+        if manifest.get('version') != SNAPSHOT_VERSION:
+            raise ValidationError("Unsupported snapshot version: %s." % manifest.get('version'))
+        tables = manifest.get('tables')
+        if not isinstance(tables, dict):
+            raise ValidationError("The snapshot manifest does not list its tables.")
+        members = set(archive.namelist())
+        for member, table, columns, query in SNAPSHOT_TABLES:
+            info = tables.get(member)
+            if not isinstance(info, dict) or info.get('columns') != [column for column, column_type in columns]:
+                raise ValidationError("The snapshot table %s does not match this version." % member)
+            rows = info.get('rows')
+            if not isinstance(rows, int) or isinstance(rows, bool) or rows < 0:
+                raise ValidationError("The snapshot table %s has an invalid row count." % member)
+            if member not in members:
+                raise ValidationError("The snapshot table %s is missing." % member)
+        return archive, manifest
+
+    def _snapshot_create_staging_table(self, table, columns):
+        # Cualificada con pg_temp para no tocar nunca una tabla normal con el mismo nombre
+        self.env.cr.execute("DROP TABLE IF EXISTS pg_temp.%s" % table)
+        self.env.cr.execute("CREATE TEMP TABLE pg_temp.%s (%s) ON COMMIT DROP" % (
+            table, ', '.join('%s %s' % column for column in columns)))
+
+    def _snapshot_validate(self, title):
+        # Las mismas reglas que los @api.constrains, pero sobre todas las filas a la vez
+        town_hall_levels = tuple(self.env['res.partner']._fields['town_hall_level'].get_values(self.env))
+        battle_states = tuple(self.env['game.battle']._fields['state'].get_values(self.env))
+        battle_results = tuple(self.env['game.battle']._fields['result'].get_values(self.env))
+        checks = [
+            ("SELECT count(*) FROM game_snapshot_building_type WHERE name IS NULL",
+             (), "Building types without a name"),
+            ("SELECT count(*) FROM (SELECT name FROM game_snapshot_building_type GROUP BY name HAVING count(*) > 1) d",
+             (), "Duplicated building type names"),
+            ("""SELECT count(*) FROM game_snapshot_building_type
+                 WHERE base_gold_cost < 0 OR base_mana_cost < 0 OR base_food_cost < 0
+                    OR upgrade_gold_cost < 0 OR upgrade_mana_cost < 0 OR upgrade_food_cost < 0""",
+             (), "Building types with negative costs"),
+            ("SELECT count(*) FROM game_snapshot_building_type WHERE base_construction_time < 0",
+             (), "Building types with negative construction time"),
+            ("SELECT count(*) FROM game_snapshot_building_type WHERE max_level IS NULL OR max_level < 1",
+             (), "Building types with a max level lower than 1"),
+            ("SELECT count(*) FROM game_snapshot_player WHERE name IS NULL",
+             (), "Players without a name"),
+            ("SELECT count(*) FROM (SELECT name FROM game_snapshot_player GROUP BY name HAVING count(*) > 1) d",
+             (), "Duplicated player names"),
+            ("""SELECT count(*) FROM game_snapshot_player
+                 WHERE gold IS NULL OR mana IS NULL OR food IS NULL OR troops IS NULL""",
+             (), "Players with empty resources"),
+            ("SELECT count(*) FROM game_snapshot_player WHERE gold < 0 OR mana < 0 OR food < 0",
+             (), "Players with negative resources"),
+            ("SELECT count(*) FROM game_snapshot_player WHERE troops < 0",
+             (), "Players with negative troops"),
+            ("SELECT count(*) FROM game_snapshot_player WHERE town_hall_level IS NULL OR town_hall_level NOT IN %s",
+             (town_hall_levels,), "Players with an invalid town hall level"),
+            ("""SELECT count(*) FROM game_snapshot_building b
+                 WHERE NOT EXISTS (SELECT 1 FROM game_snapshot_player p WHERE p.name = b.player)""",
+             (), "Buildings of unknown players"),
+            ("""SELECT count(*) FROM game_snapshot_building b
+                 WHERE NOT EXISTS (SELECT 1 FROM game_snapshot_building_type t WHERE t.name = b.building_type)
+                   AND NOT EXISTS (SELECT 1 FROM game_building_type t WHERE t.name = b.building_type)""",
+             (), "Buildings of unknown building types"),
+            ("""SELECT count(*) FROM game_snapshot_battle g
+                 WHERE NOT EXISTS (SELECT 1 FROM game_snapshot_player p WHERE p.name = g.attacker)
+                    OR NOT EXISTS (SELECT 1 FROM game_snapshot_player p WHERE p.name = g.defender)""",
+             (), "Battles of unknown players"),
+            ("SELECT count(*) FROM game_snapshot_battle WHERE state IS NOT NULL AND state NOT IN %s",
+             (battle_states,), "Battles with an invalid state"),
+            ("SELECT count(*) FROM game_snapshot_battle WHERE result IS NOT NULL AND result NOT IN %s",
+             (battle_results,), "Battles with an invalid result"),
+        ]
+        errors = []
+        for query, params, message in checks:
+            self.env.cr.execute(query, params)
+            count = self.env.cr.fetchone()[0]
+            if count:
+                errors.append("%s: %s" % (message, count))
+        if errors:
+            raise ValidationError("%s:\n%s" % (title, '\n'.join(errors)))
+
+    def _snapshot_merge_building_types(self):
+        columns = [column for column, column_type in SNAPSHOT_TABLES[0][2] if column != 'name']
+        self.env.cr.execute("""
+            WITH existing AS (
+                SELECT DISTINCT ON (name) id, name FROM game_building_type ORDER BY name, id
+            )
+            UPDATE game_building_type t
+               SET %s, write_uid = %%(uid)s, write_date = (now() at time zone 'UTC')
+              FROM game_snapshot_building_type s
+              JOIN existing e ON e.name = s.name
+             WHERE t.id = e.id
+        """ % ', '.join('%s = s.%s' % (column, column) for column in columns), {'uid': self.env.uid})
+        self.env.cr.execute("""
+            INSERT INTO game_building_type (name, %s, create_uid, create_date, write_uid, write_date)
+            SELECT s.name, %s, %%(uid)s, (now() at time zone 'UTC'), %%(uid)s, (now() at time zone 'UTC')
+              FROM game_snapshot_building_type s
+             WHERE NOT EXISTS (SELECT 1 FROM game_building_type t WHERE t.name = s.name)
+        """ % (', '.join(columns), ', '.join('s.%s' % column for column in columns)), {'uid': self.env.uid})
+
+    def _snapshot_merge_players(self):
+        Partner = self.env['res.partner']
+        columns = [column for column, column_type in SNAPSHOT_TABLES[1][2] if column != 'name']
+        self.env.cr.execute("""
+            UPDATE res_partner p
+               SET %s, write_uid = %%(uid)s, write_date = (now() at time zone 'UTC')
+              FROM game_snapshot_player s
+             WHERE p.name = s.name
+        """ % ', '.join('%s = s.%s' % (column, column) for column in columns), {'uid': self.env.uid})
+
+        # res.partner lo extienden otros modulos: los jugadores nuevos reciben
+        # los valores por defecto del ORM y luego se recalculan sus campos computados
+        skip = {'name', 'create_uid', 'create_date', 'write_uid', 'write_date'} | set(columns)
+        default_fields = [name for name, field in Partner._fields.items()
+                          if field.store and field.column_type and not field.compute and name not in skip]
+        defaults = {name: Partner._fields[name].convert_to_column(value, Partner)
+                    for name, value in Partner.default_get(default_fields).items() if name in default_fields}
+        params = {'default_%s' % name: value for name, value in defaults.items()}
+        params['uid'] = self.env.uid
+        self.env.cr.execute("""
+            INSERT INTO res_partner (name, %s, create_uid, create_date, write_uid, write_date)
+            SELECT s.name, %s, %%(uid)s, (now() at time zone 'UTC'), %%(uid)s, (now() at time zone 'UTC')
+              FROM game_snapshot_player s
+             WHERE NOT EXISTS (SELECT 1 FROM res_partner p WHERE p.name = s.name)
+            RETURNING id
+        """ % (', '.join(['"%s"' % name for name in defaults] + columns),
+               ', '.join(['%%(default_%s)s' % name for name in defaults] + ['s.%s' % column for column in columns])),
+            params)
+        new_players = Partner.browse([row[0] for row in self.env.cr.fetchall()])
+
+        self.env.invalidate_all()
+        for field in Partner._fields.values():
+            if field.store and field.compute:
+                self.env.add_to_compute(field, new_players)
+        self.env.flush_all()
+
+    def _snapshot_merge_buildings(self):
+        cr = self.env.cr
+        self._snapshot_unlink_construction_timers()
+        cr.execute("""
+            DELETE FROM game_building b
+             USING res_partner p, game_snapshot_player s
+             WHERE p.id = b.player_id AND s.name = p.name
+        """)
+        # name, player_name y completion_date se calculan aqui igual que en Building
+        cr.execute("""
+            WITH types AS (
+                SELECT DISTINCT ON (name) id, name FROM game_building_type ORDER BY name, id
+            ), inserted AS (
+            INSERT INTO game_building (name, player_id, player_name, type_id, level, is_constructed,
+                                       remaining_construction_time, construction_time, construction_start_time,
+                                       completion_date, start_date, end_date,
+                                       create_uid, create_date, write_uid, write_date)
+            SELECT t.name, p.id, p.name, t.id, s.level, s.is_constructed,
+                   s.remaining_construction_time, s.construction_time, s.construction_start_time,
+                   CASE WHEN s.construction_start_time IS NOT NULL AND s.construction_time <> 0
+                        THEN s.construction_start_time + s.construction_time * interval '1 minute' END,
+                   s.start_date, s.end_date,
+                   %(uid)s, (now() at time zone 'UTC'), %(uid)s, (now() at time zone 'UTC')
+              FROM game_snapshot_building s
+              JOIN res_partner p ON p.name = s.player
+              JOIN types t ON t.name = s.building_type
+            RETURNING id, name, is_constructed, construction_start_time, remaining_construction_time
+            )
+            SELECT id, name, remaining_construction_time
+              FROM inserted
+             WHERE is_constructed IS NOT TRUE AND construction_start_time IS NOT NULL
+        """, {'uid': self.env.uid})
+        in_progress = cr.fetchall()
+
+        # Vuelve a lanzar los temporizadores de los edificios en construccion
+        model_id = self.env.ref('game.model_game_building').id
+        self.env['ir.cron'].sudo().create([{
+            'name': f"Construction Timer for {name}",
+            'model_id': model_id,
+            'state': 'code',
+            'code': f"model.browse({building_id}).update_construction_state()",
+            'interval_number': 1,
+            'interval_type': 'minutes',
+            'numbercall': (remaining or 0) + 1,
+            'doall': False,
+            'active': True
+        } for building_id, name, remaining in in_progress])
+
+    def _snapshot_unlink_construction_timers(self):
+        # Temporizadores de los edificios que se van a sustituir, sacando el id del codigo del cron
+        self.env.cr.execute(r"""
+            SELECT c.id
+              FROM ir_cron c
+              JOIN ir_act_server a ON a.id = c.ir_actions_server_id
+             WHERE a.model_id = %s
+               AND a.code ~ '^model\.browse\(\d+\)\.update_construction_state\(\)$'
+               AND substring(a.code from '^model\.browse\((\d+)\)')::integer IN (
+                   SELECT b.id FROM game_building b
+                     JOIN res_partner p ON p.id = b.player_id
+                     JOIN game_snapshot_player s ON s.name = p.name)
+        """, (self.env.ref('game.model_game_building').id,))
+        self.env['ir.cron'].sudo().browse([row[0] for row in self.env.cr.fetchall()]).unlink()
+
+    def _snapshot_merge_battles(self):
+        self.env.cr.execute("""
+            WITH players AS (
+                SELECT p.id FROM res_partner p JOIN game_snapshot_player s ON s.name = p.name
+            )
+            DELETE FROM game_battle
+             WHERE attacker_id IN (SELECT id FROM players)
+                OR defender_id IN (SELECT id FROM players)
+        """)
+        self.env.cr.execute("""
+            INSERT INTO game_battle (attacker_id, defender_id, result, state, progress, start_date, end_date,
+                                     create_uid, create_date, write_uid, write_date)
+            SELECT a.id, d.id, s.result, COALESCE(s.state, 'draft'), s.progress, s.start_date, s.end_date,
+                   %(uid)s, (now() at time zone 'UTC'), %(uid)s, (now() at time zone 'UTC')
+              FROM game_snapshot_battle s
+              JOIN res_partner a ON a.name = s.attacker
+              JOIN res_partner d ON d.name = s.defender
+        """, {'uid': self.env.uid})
+        self.env.invalidate_all()
+
+
 class ResCreationWizard(models.TransientModel):
     _name = 'res.partner.creation.wizard'
     _description = 'Sin esto no funciona no se si es por la base de datos o que '
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import io
+import json
+import zipfile
+from datetime import timedelta
+
+from odoo import fields
+from odoo.exceptions import AccessError, ValidationError
+from odoo.tests.common import TransactionCase, new_test_user
+
+
+class TestSnapshot(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.Snapshot = cls.env['game.snapshot.wizard']
+        cls.maria = cls.env.ref('game.Maria')
+        cls.ivan = cls.env.ref('game.Juan')
+        start_date = fields.Datetime.now()
+        cls.env['game.battle'].create({
+            'attacker_id': cls.maria.id,
+            'defender_id': cls.ivan.id,
+            'state': 'in_progress',
+            'progress': 40,
+            'start_date': start_date,
+            'end_date': start_date + timedelta(minutes=3),
+        })
+
+    def _world_state(self):
+        players = self.env['res.partner'].browse([self.maria.id, self.ivan.id])
+        buildings = self.env['game.building'].search([('player_id', 'in', players.ids)])
+        battles = self.env['game.battle'].search(['|', ('attacker_id', 'in', players.ids),
+                                                  ('defender_id', 'in', players.ids)])
+        return {
+            'players': sorted((p.name, p.is_player, p.town_hall_level, p.gold, p.mana, p.food, p.troops)
+                              for p in players),
+            'buildings': sorted((b.player_id.name, b.type_id.name, b.name, b.player_name, b.level, b.is_constructed,
+                                 b.remaining_construction_time, b.construction_time,
+                                 b.construction_start_time, b.completion_date)
+                                for b in buildings),
+            'battles': sorted((g.attacker_id.name, g.defender_id.name, g.result or '', g.state, g.progress,
+                               g.start_date, g.end_date)
+                              for g in battles),
+        }
+
+    def _timers(self, building):
+        return self.env['ir.cron'].with_context(active_test=False).search([
+            ('code', '=', f"model.browse({building.id}).update_construction_state()"),
+        ])
+
+    def _rewrite_snapshot(self, data, member, update_rows):
+        source = zipfile.ZipFile(io.BytesIO(data))
+        rows = list(csv.reader(io.StringIO(source.read(member).decode())))
+        update_rows(rows[0], rows[1:])
+        content = io.StringIO()
+        csv.writer(content).writerows(rows)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as target:
+            for name in source.namelist():
+                target.writestr(name, content.getvalue() if name == member else source.read(name))
+        return buffer.getvalue()
+
+    def test_round_trip(self):
+        state = self._world_state()
+        old_buildings = self.maria.buildings
+        self.assertEqual(len(state['buildings']), 4)
+        self.assertEqual(len(state['battles']), 1)
+
+        self.Snapshot.import_snapshot(self.Snapshot.export_snapshot())
+
+        self.assertEqual(self._world_state(), state)
+        self.assertFalse(old_buildings.exists())
+
+    def test_round_trip_restarts_construction_timers(self):
+        building = self.env['game.building'].create({
+            'player_id': self.ivan.id,
+            'type_id': self.env.ref('game.building_type_mine').id,
+        })
+        building.action_construct()
+        self.assertEqual(len(self._timers(building)), 1)
+
+        self.Snapshot.import_snapshot(self.Snapshot.export_snapshot())
+
+        self.assertFalse(self._timers(building))
+        restored = self.env['game.building'].search([('player_id', '=', self.ivan.id)])
+        self.assertEqual(len(restored), 1)
+        self.assertEqual(restored.remaining_construction_time, 60)
+        timer = self._timers(restored)
+        self.assertEqual(len(timer), 1)
+        self.assertEqual(timer.numbercall, 61)
+
+    def test_import_rejects_invalid_rows(self):
+        data = self.Snapshot.export_snapshot()
+
+        def negative_gold(header, rows):
+            rows[0][header.index('gold')] = '-5'
+
+        def unknown_type(header, rows):
+            rows[0][header.index('building_type')] = 'Unknown Building'
+
+        data = self._rewrite_snapshot(data, 'players.csv', negative_gold)
+        data = self._rewrite_snapshot(data, 'buildings.csv', unknown_type)
+        with self.assertRaises(ValidationError) as error:
+            self.Snapshot.import_snapshot(data)
+        self.assertIn("Players with negative resources: 1", str(error.exception))
+        self.assertIn("Buildings of unknown building types: 1", str(error.exception))
+
+    def test_import_rejects_malformed_manifest(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('manifest.json', json.dumps({'format': 'game.snapshot', 'version': 1, 'tables': []}))
+        with self.assertRaises(ValidationError):
+            self.Snapshot.import_snapshot(buffer.getvalue())
+
+    def test_import_rejects_malformed_values(self):
+        def text_gold(header, rows):
+            rows[0][header.index('gold')] = 'abc'
+
+        data = self._rewrite_snapshot(self.Snapshot.export_snapshot(), 'players.csv', text_gold)
+        with self.assertRaises(ValidationError) as error:
+            self.Snapshot.import_snapshot(data)
+        self.assertIn("The snapshot table players.csv is malformed", str(error.exception))
+
+    def test_import_rejects_duplicated_building_types(self):
+        def duplicated_name(header, rows):
+            rows[1][header.index('name')] = rows[0][header.index('name')]
+
+        data = self._rewrite_snapshot(self.Snapshot.export_snapshot(), 'building_types.csv', duplicated_name)
+        with self.assertRaises(ValidationError) as error:
+            self.Snapshot.import_snapshot(data)
+        self.assertIn("Duplicated building type names: 1", str(error.exception))
+
+    def test_snapshot_requires_settings_group(self):
+        users = new_test_user(self.env, login='snapshot_user', groups='base.group_user') \
+            | new_test_user(self.env, login='snapshot_manager', groups='base.group_user,base.group_erp_manager')
+        for user in users:
+            with self.assertRaises(AccessError):
+                self.Snapshot.with_user(user).export_snapshot()
+            with self.assertRaises(AccessError):
+                self.Snapshot.with_user(user).import_snapshot(b'')